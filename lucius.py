@@ -1,8 +1,14 @@
 import os
+import csv
+import tempfile
 import re
 import json
+import hashlib
 import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from pathlib import Path
@@ -16,7 +22,9 @@ from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import nest_asyncio
 import gspread
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
+from openpyxl import Workbook
 
 # ---------------------- TIMEZONE SETUP ----------------------
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
@@ -65,6 +73,7 @@ NOTES_DIR: Path = Path("notes")
 TEMP_DIR: Path = Path("temp")
 GRAFIK_PATH = Path("grafik.json")
 LAST_ACTIVITY_PATH = Path("last_activity.json")
+PHOTO_SIZE_STATS_PATH = Path("photo_size_stats.json")
 
 pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
 
@@ -148,12 +157,100 @@ def get_user_reply_markup(user_id: int) -> Optional[ReplyKeyboardMarkup]:
 def is_user_allowed(user_id: int) -> bool:
     return user_id in ALLOWED_USERS
 
-def is_duplicate(file_path: Path, new_note: str) -> bool:
-    if not file_path.exists():
-        return False
-    with file_path.open('r', encoding='utf-8') as file:
-        existing_notes = json.load(file)
-    return new_note in existing_notes
+# -------------------- NOTES STORE --------------------
+# Заметки каждого пользователя — append-only лог notes/notes_<user_id>.jsonl.
+# Лог один раз проигрывается в память; дальше сохранение, проверка дубликата
+# и удаление последней заметки работают за O(1). Когда удалённых записей
+# становится больше живых, лог переписывается (компакция).
+NOTES_PAGE_SIZE: int = 10
+NOTES_COMPACT_MIN_DEAD: int = 50
+notes_cache: dict[int, dict] = {}
+
+def notes_path(user_id: int) -> Path:
+    return NOTES_DIR / f"notes_{user_id}.jsonl"
+
+def note_hash(text: str) -> str:
+    return hashlib.sha1(text.strip().encode("utf-8")).hexdigest()
+
+def load_user_notes(user_id: int) -> dict:
+    state = notes_cache.get(user_id)
+    if state is not None:
+        return state
+    state = {"notes": [], "hashes": set(), "dead": 0, "next_id": 1}
+    path = notes_path(user_id)
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.error(f"Skipping corrupted note record in {path}")
+                    continue
+                if record.get("op") == "meta":
+                    state["next_id"] = max(state["next_id"], record["next_id"])
+                elif record.get("op") == "add":
+                    state["notes"].append(record)
+                    state["hashes"].add(record["hash"])
+                    state["next_id"] = max(state["next_id"], record["id"] + 1)
+                elif record.get("op") == "del" and state["notes"] and state["notes"][-1]["id"] == record["id"]:
+                    state["hashes"].discard(state["notes"].pop()["hash"])
+                    state["dead"] += 2
+    notes_cache[user_id] = state
+    return state
+
+def append_note_record(user_id: int, record: dict) -> None:
+    NOTES_DIR.mkdir(parents=True, exist_ok=True)
+    with notes_path(user_id).open("a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def add_note(user_id: int, text: str) -> Optional[dict]:
+    state = load_user_notes(user_id)
+    digest = note_hash(text)
+    if digest in state["hashes"]:
+        return None
+    record = {"op": "add", "id": state["next_id"], "hash": digest, "ts": now_moscow().strftime("%d.%m. %H:%M"), "text": text}
+    append_note_record(user_id, record)
+    state["notes"].append(record)
+    state["hashes"].add(digest)
+    state["next_id"] += 1
+    return record
+
+def delete_last_user_note(user_id: int) -> Optional[dict]:
+    state = load_user_notes(user_id)
+    if not state["notes"]:
+        return None
+    record = state["notes"][-1]
+    append_note_record(user_id, {"op": "del", "id": record["id"]})
+    state["notes"].pop()
+    state["hashes"].discard(record["hash"])
+    state["dead"] += 2
+    if state["dead"] >= NOTES_COMPACT_MIN_DEAD and state["dead"] > len(state["notes"]):
+        compact_user_notes(user_id)
+    return record
+
+def compact_user_notes(user_id: int) -> None:
+    state = load_user_notes(user_id)
+    path = notes_path(user_id)
+    tmp_path = path.with_suffix(".jsonl.tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        # next_id сохраняется отдельно, иначе после перезапуска номера удалённых заметок переиспользуются
+        f.write(json.dumps({"op": "meta", "next_id": state["next_id"]}) + "\n")
+        for record in state["notes"]:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    logging.info(f"Compacted notes for user {user_id}: dropped {state['dead']} records")
+    state["dead"] = 0
+
+def list_user_notes(user_id: int, page: int = 1) -> Tuple[List[dict], int]:
+    # Новые заметки первыми
+    notes = load_user_notes(user_id)["notes"]
+    total_pages = max((len(notes) + NOTES_PAGE_SIZE - 1) // NOTES_PAGE_SIZE, 1)
+    page = min(max(page, 1), total_pages)
+    end = len(notes) - (page - 1) * NOTES_PAGE_SIZE
+    start = max(end - NOTES_PAGE_SIZE, 0)
+    return list(reversed(notes[start:end])), total_pages
 
 def log_unauthorized_access(user_id: int, action: str):
     logging.warning(f"Unauthorized access attempt: user_id={user_id}, action={action}")
@@ -164,6 +261,87 @@ async def notify_admin(context: ContextTypes.DEFAULT_TYPE, text: str):
     except Exception as e:
         logging.error(f"Failed to notify admin: {e}")
 
+# -------------------- EXECUTORS --------------------
+# Отдельные пулы потоков под каждый тип нагрузки, чтобы тяжёлая аналитика
+# не забивала потоки записи сканов. У каждого пула ограничена очередь:
+# если заняты все max_workers + max_queue мест, задача сразу отклоняется.
+class ExecutorOverloadedError(RuntimeError):
+    pass
+
+class BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            logging.warning(f"Executor {self.name} is full, task rejected")
+            raise ExecutorOverloadedError(f"Очередь {self.name} переполнена, попробуйте позже.")
+        with self._lock:
+            self.in_flight += 1
+        enqueued_at = time.monotonic()
+
+        def _task():
+            started_at = time.monotonic()
+            with self._lock:
+                self.active += 1
+            try:
+                return func(*args)
+            finally:
+                finished_at = time.monotonic()
+                with self._lock:
+                    self.active -= 1
+                    self.in_flight -= 1
+                    self.completed += 1
+                    self.total_wait += started_at - enqueued_at
+                    self.total_run += finished_at - started_at
+                    self.max_wait = max(self.max_wait, started_at - enqueued_at)
+                self._slots.release()
+
+        def _release_if_cancelled(future):
+            # Отменённая до старта задача не выполнит finally в _task — освобождаем слот здесь
+            if future.cancelled():
+                with self._lock:
+                    self.in_flight -= 1
+                self._slots.release()
+
+        future = self._pool.submit(_task)
+        future.add_done_callback(_release_if_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def stats_line(self) -> str:
+        with self._lock:
+            queued = self.in_flight - self.active
+            avg_wait = self.total_wait / self.completed * 1000 if self.completed else 0
+            avg_run = self.total_run / self.completed * 1000 if self.completed else 0
+            return (
+                f"{self.name}: занято {self.active}/{self.max_workers}, очередь {queued}/{self.max_queue}, "
+                f"выполнено {self.completed}, отклонено {self.rejected}, "
+                f"ожидание ср. {avg_wait:.0f} мс (макс. {self.max_wait * 1000:.0f} мс), работа ср. {avg_run:.0f} мс"
+            )
+
+SHEETS_WRITE_EXECUTOR = BoundedExecutor("sheets-write", max_workers=4, max_queue=32)
+SHEETS_READ_EXECUTOR = BoundedExecutor("sheets-read", max_workers=2, max_queue=4)
+AUX_IO_EXECUTOR = BoundedExecutor("aux-io", max_workers=4, max_queue=16)
+IMAGE_EXECUTOR = BoundedExecutor("image", max_workers=2, max_queue=32)
+EXECUTORS: Tuple[BoundedExecutor, ...] = (SHEETS_WRITE_EXECUTOR, SHEETS_READ_EXECUTOR, AUX_IO_EXECUTOR, IMAGE_EXECUTOR)
+
+def get_executor_stats_message() -> str:
+    return "Пулы потоков:\n" + "\n".join(executor.stats_line() for executor in EXECUTORS)
+
 # -------------------- ASYNC GOOGLE SHEETS --------------------
 def authorize_google_sheets() -> gspread.Client:
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
@@ -172,12 +350,11 @@ def authorize_google_sheets() -> gspread.Client:
     return client
 
 async def get_spreadsheet_async() -> gspread.Spreadsheet:
-    loop = asyncio.get_running_loop()
     def _func():
         client = authorize_google_sheets()
         spreadsheet = client.open_by_url(GOOGLE_SHEET_URL)
         return spreadsheet
-    return await loop.run_in_executor(None, _func)
+    return await AUX_IO_EXECUTOR.run(_func)
 
 user_names: dict[int, str] = {
     1181905320: "Соболев Владислав",
@@ -212,9 +389,140 @@ user_column_map: dict[str, Tuple[int, int]] = {
     "Саранцев Игорь": (27, 28),
 }
 
+# ------------ GLOBAL SCOOTER INDEX -------------------
+# Номер самоката -> {сотрудник: (строка, время)} за последние SCOOTER_INDEX_WINDOW_HOURS.
+# Позволяет за O(1) заметить, что тот же самокат уже сдал другой сотрудник,
+# не перечитывая все колонки. Индекс собирается из таблицы при старте и в background_refresh.
+SCOOTER_INDEX_WINDOW_HOURS: int = int(os.environ.get("SCOOTER_INDEX_WINDOW_HOURS", "12"))
+scooter_index: dict[str, dict[str, Tuple[int, datetime]]] = {}
+scooter_index_lock = threading.Lock()
+user_ids_by_name: dict[str, int] = {name: uid for uid, name in user_names.items()}
+
+def parse_sheet_datetime(date_str: str) -> Optional[datetime]:
+    # В таблице год не пишется: берём текущий, а "будущие" даты относим к прошлому году.
+    # Год подставляется до strptime, иначе 29.02 не разберётся (по умолчанию 1900 год)
+    now = now_moscow()
+    try:
+        parsed = datetime.strptime(f"{date_str.strip()} {now.year}", "%d.%m. %H:%M %Y").replace(tzinfo=MOSCOW_TZ)
+        if parsed > now + timedelta(days=1):
+            parsed = datetime.strptime(f"{date_str.strip()} {now.year - 1}", "%d.%m. %H:%M %Y").replace(tzinfo=MOSCOW_TZ)
+    except ValueError:
+        return None
+    return parsed
+
+def scooter_index_cutoff() -> datetime:
+    return now_moscow() - timedelta(hours=SCOOTER_INDEX_WINDOW_HOURS)
+
+def claim_scan(number: str, user_name: str, row: int, scanned_at: datetime) -> Tuple[List[Tuple[str, int, datetime]], Optional[Tuple[int, datetime]]]:
+    # Проверка и предварительная регистрация под одной блокировкой: записи разных
+    # сотрудников идут параллельно, и два почти одновременных скана должны увидеть друг друга.
+    # Возвращает сканы других сотрудников и прежнюю запись этого сотрудника (для release_scan).
+    cutoff = scooter_index_cutoff()
+    with scooter_index_lock:
+        entries = scooter_index.setdefault(number, {})
+        for name in [n for n, (_, at) in entries.items() if at < cutoff]:
+            del entries[name]
+        hits = [(name, other_row, at) for name, (other_row, at) in entries.items() if name != user_name]
+        previous = entries.get(user_name)
+        entries[user_name] = (row, scanned_at)
+        return hits, previous
+
+def release_scan(number: str, user_name: str, row: int, previous: Optional[Tuple[int, datetime]]) -> None:
+    # Откат claim_scan, если запись в таблицу не удалась
+    with scooter_index_lock:
+        entries = scooter_index.get(number)
+        if not entries or entries.get(user_name, (None,))[0] != row:
+            return
+        if previous is None:
+            del entries[user_name]
+            if not entries:
+                del scooter_index[number]
+        else:
+            entries[user_name] = previous
+
+def build_cross_worker_highlight_requests(sheet_id: int, row: int, user_name: str, hits: List[Tuple[str, int, datetime]]) -> List[dict]:
+    requests = build_duplicate_highlight_requests(sheet_id, row, user_column_map[user_name], CROSS_DUPLICATE_COLOR)
+    for other_name, other_row, _ in hits:
+        requests.extend(build_duplicate_highlight_requests(sheet_id, other_row, user_column_map[other_name], CROSS_DUPLICATE_COLOR))
+    return requests
+
+def rebuild_scooter_index(spreadsheet: gspread.Spreadsheet, sheet_name: str) -> None:
+    sheet = spreadsheet.worksheet(sheet_name)
+    all_data = sheet.get_all_values()
+    cutoff = scooter_index_cutoff()
+    index: dict[str, dict[str, Tuple[int, datetime]]] = {}
+    for row_number, row in enumerate(all_data[1:], start=2):
+        for user_name, (col_number, date_col) in user_column_map.items():
+            num_idx, date_idx = col_number - 1, date_col - 1
+            if len(row) <= max(num_idx, date_idx) or not row[num_idx].strip():
+                continue
+            scanned_at = parse_sheet_datetime(row[date_idx])
+            if scanned_at is None or scanned_at < cutoff:
+                continue
+            index.setdefault(row[num_idx].strip().lstrip("'"), {})[user_name] = (row_number, scanned_at)
+    with scooter_index_lock:
+        # Сканы, записанные пока читалась таблица, в снимок не попали — переносим их из старого индекса
+        for number, entries in scooter_index.items():
+            for user_name, (row, scanned_at) in entries.items():
+                current = index.get(number, {}).get(user_name)
+                if scanned_at >= cutoff and (current is None or scanned_at > current[1]):
+                    index.setdefault(number, {})[user_name] = (row, scanned_at)
+        scooter_index.clear()
+        scooter_index.update(index)
+    logging.info(f"Scooter index rebuilt: {len(index)} scooters in the last {SCOOTER_INDEX_WINDOW_HOURS}h")
+
+async def rebuild_scooter_index_async(spreadsheet: gspread.Spreadsheet, sheet_name: str) -> None:
+    await SHEETS_READ_EXECUTOR.run(rebuild_scooter_index, spreadsheet, sheet_name)
+
+async def notify_cross_worker_duplicates(context: ContextTypes.DEFAULT_TYPE, user_id: int, cross_hits: List[Tuple[str, str, int, datetime]]) -> None:
+    user_name = user_names.get(user_id, "Unknown User")
+    for number, other_name, _, scanned_at in cross_hits:
+        when = scanned_at.strftime("%d.%m. %H:%M")
+        messages = [(user_id, f"⚠️ Самокат {number} уже сдал {other_name} ({when}).")]
+        other_id = user_ids_by_name.get(other_name)
+        if other_id:
+            messages.append((other_id, f"⚠️ Самокат {number}, который вы сдали {when}, повторно отсканировал {user_name}."))
+        for chat_id, text in messages:
+            try:
+                await context.bot.send_message(chat_id=chat_id, text=text)
+            except Exception as e:
+                logging.error(f"Failed to notify {chat_id} about cross-worker duplicate: {e}")
+
 # ------------ SHEETS API LIMITS & RETRIES -------------------
-async def append_to_google_sheets_async(spreadsheet: gspread.Spreadsheet, sheet_name: str, user_id: int, data: List[str], context=None) -> None:
-    loop = asyncio.get_running_loop()
+DUPLICATE_COLOR: dict = {"red": 1, "green": 0, "blue": 0}
+CROSS_DUPLICATE_COLOR: dict = {"red": 1, "green": 0.6, "blue": 0}
+
+def build_duplicate_highlight_requests(sheet_id: int, row: int, columns: Tuple[int, ...], color: dict = DUPLICATE_COLOR) -> List[dict]:
+    return [{
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": row - 1,
+                "endRowIndex": row,
+                "startColumnIndex": column - 1,
+                "endColumnIndex": column
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "backgroundColor": color
+                }
+            },
+            "fields": "userEnteredFormat.backgroundColor"
+        }
+    } for column in columns]
+
+# Запись одного сотрудника идёт строго по очереди: иначе две записи прочитают
+# одинаковый next_row и вторая затрёт первую (альбомы обрабатываются вне очереди PTB).
+user_write_locks: dict[int, asyncio.Lock] = {}
+
+def get_user_write_lock(user_id: int) -> asyncio.Lock:
+    lock = user_write_locks.get(user_id)
+    if lock is None:
+        lock = user_write_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def append_to_google_sheets_async(spreadsheet: gspread.Spreadsheet, sheet_name: str, user_id: int, data: List[str], context=None) -> bool:
+    # Возвращает False, если номер так и не записан (ошибки API или переполненный пул записи)
     max_attempts = 3
     for attempt in range(max_attempts):
         try:
@@ -223,72 +531,135 @@ async def append_to_google_sheets_async(spreadsheet: gspread.Spreadsheet, sheet_
                     sheet = spreadsheet.worksheet(sheet_name)
                 except Exception as e:
                     logging.error(f"Error accessing worksheet {sheet_name}: {e}")
-                    return
+                    return False, []
 
                 user_name: str = user_names.get(user_id, "Unknown User")
                 user_columns: Optional[Tuple[int, int]] = user_column_map.get(user_name)
                 if not user_columns:
                     logging.error(f"No columns assigned for user: {user_name}")
-                    return
+                    return False, []
 
                 number_column, datetime_column = user_columns
                 next_row: int = max(len(sheet.col_values(number_column)) + 1, 2)
-                current_datetime: str = now_moscow().strftime("%d.%m. %H:%M")
+                scanned_at = now_moscow()
+                current_datetime: str = scanned_at.strftime("%d.%m. %H:%M")
                 existing_numbers: List[str] = sheet.col_values(number_column)[1:]
+                requests: List[dict] = []
                 if data[0] in existing_numbers:
                     duplicate_row: int = existing_numbers.index(data[0]) + 2
-                    requests = [{
-                        "repeatCell": {
-                            "range": {
-                                "sheetId": sheet._properties['sheetId'],
-                                "startRowIndex": duplicate_row - 1,
-                                "endRowIndex": duplicate_row,
-                                "startColumnIndex": number_column - 1,
-                                "endColumnIndex": number_column
-                            },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": {"red": 1, "green": 0, "blue": 0}
-                                }
-                            },
-                            "fields": "userEnteredFormat.backgroundColor"
-                        }
-                    }, {
-                        "repeatCell": {
-                            "range": {
-                                "sheetId": sheet._properties['sheetId'],
-                                "startRowIndex": duplicate_row - 1,
-                                "endRowIndex": duplicate_row,
-                                "startColumnIndex": datetime_column - 1,
-                                "endColumnIndex": datetime_column
-                            },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": {"red": 1, "green": 0, "blue": 0}
-                                }
-                            },
-                            "fields": "userEnteredFormat.backgroundColor"
-                        }
-                    }]
-                    spreadsheet.batch_update({"requests": requests})
+                    requests.extend(build_duplicate_highlight_requests(sheet._properties['sheetId'], duplicate_row, user_columns))
                     logging.info(f"Duplicate scooter found and highlighted: {data[0]} at row {duplicate_row}")
-
-                sheet.update_cell(next_row, number_column, f"'{data[0]}")
-                sheet.update_cell(next_row, datetime_column, current_datetime)
+                hits, previous = claim_scan(data[0], user_name, next_row, scanned_at)
+                try:
+                    if hits:
+                        requests.extend(build_cross_worker_highlight_requests(sheet._properties['sheetId'], next_row, user_name, hits))
+                        logging.info(f"Cross-worker duplicate: {data[0]} scanned by {user_name} and {[h[0] for h in hits]}")
+                    if requests:
+                        spreadsheet.batch_update({"requests": requests})
+
+                    sheet.update_cell(next_row, number_column, f"'{data[0]}")
+                    sheet.update_cell(next_row, datetime_column, current_datetime)
+                except Exception:
+                    release_scan(data[0], user_name, next_row, previous)
+                    raise
                 logging.info(f"Data appended to Google Sheets at row {next_row}: {data[0]}, {current_datetime}")
-            await loop.run_in_executor(None, _func)
+                return True, [(data[0], *hit) for hit in hits]
+            async with get_user_write_lock(user_id):
+                saved, cross_hits = await SHEETS_WRITE_EXECUTOR.run(_func)
+            if cross_hits and context:
+                await notify_cross_worker_duplicates(context, user_id, cross_hits)
             await asyncio.sleep(1)
-            break
+            return saved
         except Exception as e:
             logging.error(f"Google Sheets update error (attempt {attempt+1}): {e}")
+            if isinstance(e, ExecutorOverloadedError) and attempt < max_attempts - 1:
+                await asyncio.sleep(1)
             if "429" in str(e) and context:
                 await notify_admin(context, f"Google Sheets API rate limit (429) при обновлении. user_id={user_id}, данные={data}")
                 await asyncio.sleep(5)
             elif attempt == max_attempts - 1 and context:
                 await notify_admin(context, f"Ошибка записи в Google Sheets после {max_attempts} попыток. user_id={user_id}, данные={data}")
+    return False
+
+async def append_batch_to_google_sheets_async(spreadsheet: gspread.Spreadsheet, sheet_name: str, user_id: int, numbers: List[str], context=None) -> Tuple[bool, List[str]]:
+    # Пишет номера одной пачкой; возвращает флаг успеха и номера, которые уже были в таблице
+    max_attempts = 3
+    for attempt in range(max_attempts):
+        try:
+            def _func() -> Tuple[bool, List[str], list]:
+                try:
+                    sheet = spreadsheet.worksheet(sheet_name)
+                except Exception as e:
+                    logging.error(f"Error accessing worksheet {sheet_name}: {e}")
+                    return False, [], []
+
+                user_name: str = user_names.get(user_id, "Unknown User")
+                user_columns: Optional[Tuple[int, int]] = user_column_map.get(user_name)
+                if not user_columns:
+                    logging.error(f"No columns assigned for user: {user_name}")
+                    return False, [], []
+
+                number_column, datetime_column = user_columns
+                column_values: List[str] = sheet.col_values(number_column)
+                next_row: int = max(len(column_values) + 1, 2)
+                existing_numbers: List[str] = column_values[1:]
+                scanned_at = now_moscow()
+                current_datetime: str = scanned_at.strftime("%d.%m. %H:%M")
+
+                duplicates: List[str] = []
+                cross_hits: List[Tuple[str, str, int, datetime]] = []
+                claims: List[Tuple[str, int, Optional[Tuple[int, datetime]]]] = []
+                requests: List[dict] = []
+                try:
+                    for offset, number in enumerate(numbers):
+                        if number in existing_numbers:
+                            duplicate_row: int = existing_numbers.index(number) + 2
+                            requests.extend(build_duplicate_highlight_requests(sheet._properties['sheetId'], duplicate_row, user_columns))
+                            duplicates.append(number)
+                        hits, previous = claim_scan(number, user_name, next_row + offset, scanned_at)
+                        claims.append((number, next_row + offset, previous))
+                        if hits:
+                            requests.extend(build_cross_worker_highlight_requests(sheet._properties['sheetId'], next_row + offset, user_name, hits))
+                            cross_hits.extend((number, *hit) for hit in hits)
+                    if requests:
+                        spreadsheet.batch_update({"requests": requests})
+                        logging.info(f"Duplicate scooters found and highlighted: {duplicates}, cross-worker: {[h[0] for h in cross_hits]}")
+
+                    last_row: int = next_row + len(numbers) - 1
+                    sheet.batch_update([
+                        {
+                            "range": f"{rowcol_to_a1(next_row, number_column)}:{rowcol_to_a1(last_row, number_column)}",
+                            "values": [[f"'{number}"] for number in numbers]
+                        },
+                        {
+                            "range": f"{rowcol_to_a1(next_row, datetime_column)}:{rowcol_to_a1(last_row, datetime_column)}",
+                            "values": [[current_datetime] for _ in numbers]
+                        }
+                    ], value_input_option="USER_ENTERED")
+                except Exception:
+                    for number, row, previous in reversed(claims):
+                        release_scan(number, user_name, row, previous)
+                    raise
+                logging.info(f"Batch of {len(numbers)} appended to Google Sheets at rows {next_row}-{last_row}: {numbers}")
+                return True, duplicates, cross_hits
+            async with get_user_write_lock(user_id):
+                saved, duplicates, cross_hits = await SHEETS_WRITE_EXECUTOR.run(_func)
+            if cross_hits and context:
+                await notify_cross_worker_duplicates(context, user_id, cross_hits)
+            await asyncio.sleep(1)
+            return saved, duplicates
+        except Exception as e:
+            logging.error(f"Google Sheets batch update error (attempt {attempt+1}): {e}")
+            if isinstance(e, ExecutorOverloadedError) and attempt < max_attempts - 1:
+                await asyncio.sleep(1)
+            if "429" in str(e) and context:
+                await notify_admin(context, f"Google Sheets API rate limit (429) при пакетном обновлении. user_id={user_id}, данные={numbers}")
+                await asyncio.sleep(5)
+            elif attempt == max_attempts - 1 and context:
+                await notify_admin(context, f"Ошибка пакетной записи в Google Sheets после {max_attempts} попыток. user_id={user_id}, данные={numbers}")
+    return False, []
 
 async def analyze_google_sheet_data_optimized_async(spreadsheet: gspread.Spreadsheet, sheet_name: str) -> str:
-    loop = asyncio.get_running_loop()
     def _func():
         logging.info("Called optimized analyze_google_sheet_data")
         sheet = spreadsheet.worksheet(sheet_name)
@@ -335,10 +706,9 @@ async def analyze_google_sheet_data_optimized_async(spreadsheet: gspread.Spreads
         summary_lines.append(f"Всего дубликатов: {overall_duplicates}")
         summary_lines.append(f"Исполнителей: {len(active_users)}")
         return "\n\n".join(summary_lines)
-    return await loop.run_in_executor(None, _func)
+    return await SHEETS_READ_EXECUTOR.run(_func)
 
 async def get_personal_stats(spreadsheet: gspread.Spreadsheet, user_id: int) -> str:
-    loop = asyncio.get_running_loop()
     def _func():
         sheet = spreadsheet.worksheet("QR Codes")
         all_data = sheet.get_all_values()
@@ -456,16 +826,146 @@ async def get_personal_stats(spreadsheet: gspread.Spreadsheet, user_id: int) ->
             f"🏆 Ранг среди пользователей: *{rank} место*"
         )
         return text
-    return await loop.run_in_executor(None, _func)
+    return await SHEETS_READ_EXECUTOR.run(_func)
+
+# ------------- ЭКСПОРТ ИСТОРИИ -------------
+# Лист читается один раз кусками по EXPORT_CHUNK_ROWS строк, результат пишется в CSV
+# или в write-only книгу openpyxl; в памяти держится только первый скан каждого номера.
+EXPORT_CHUNK_ROWS: int = 500
+EXPORT_HEADER: List[str] = ["Сотрудник", "Самокат", "Дата и время", "Дата", "Время", "Повтор у сотрудника", "Повтор у других"]
+EXPORT_USAGE: str = "Формат: /export [дд.мм] [дд.мм] [csv|xlsx] [фамилии]\nНапример: /export 28.12 05.01 csv Соболев"
+
+def parse_export_date(arg: str) -> datetime:
+    # Как и в таблице, год не указывается: берём текущий, будущие даты относим к прошлому году
+    now = now_moscow()
+    parsed = datetime.strptime(f"{arg}.{now.year}", "%d.%m.%Y")
+    if parsed.date() > now.date():
+        parsed = datetime.strptime(f"{arg}.{now.year - 1}", "%d.%m.%Y")
+    return parsed
+
+def parse_export_args(args: List[str]) -> Tuple[datetime, datetime, str, List[str]]:
+    # Бросает ValueError на несуществующих датах (31.04, 32.13, 29.02 в невисокосный год)
+    dates: List[datetime] = []
+    export_format = "xlsx"
+    user_filters: List[str] = []
+    for arg in args:
+        if re.fullmatch(r'\d{2}\.\d{2}', arg):
+            dates.append(parse_export_date(arg))
+        elif arg.lower() in ("csv", "xlsx"):
+            export_format = arg.lower()
+        else:
+            user_filters.append(arg.lower())
+    if len(dates) > 2:
+        raise ValueError("too many dates")
+    if not dates:
+        dates = [parse_export_date(now_moscow().strftime("%d.%m"))]
+    date_from, date_to = dates[0], dates[-1]
+    # Диапазон через Новый год (28.12 05.01): начало относится к прошлому году
+    if date_from > date_to:
+        date_from = date_from.replace(year=date_to.year - 1)
+    selected_users = [
+        name for name in user_column_map
+        if not user_filters or any(f in name.lower() for f in user_filters)
+    ]
+    return date_from, date_to, export_format, selected_users
+
+def iter_sheet_chunks(sheet: gspread.Worksheet, last_column: int):
+    start = 2
+    while start <= sheet.row_count:
+        end = start + EXPORT_CHUNK_ROWS - 1
+        rows = sheet.get(f"A{start}:{rowcol_to_a1(end, last_column)}")
+        if not rows:
+            break
+        yield start, rows
+        start = end + 1
+
+def iter_export_scans(sheet: gspread.Worksheet, date_from: datetime, date_to: datetime, selected_users: List[str]):
+    last_column = max(col for cols in user_column_map.values() for col in cols)
+    for first_row, rows in iter_sheet_chunks(sheet, last_column):
+        for row_number, row in enumerate(rows, start=first_row):
+            for user_name in selected_users:
+                number_column, date_column = user_column_map[user_name]
+                num_idx, date_idx = number_column - 1, date_column - 1
+                if len(row) <= max(num_idx, date_idx):
+                    continue
+                number, date_str = row[num_idx].strip(), row[date_idx].strip()
+                if not number or not date_str:
+                    continue
+                parsed_date = parse_sheet_datetime(date_str)
+                if parsed_date is None or not (date_from.date() <= parsed_date.date() <= date_to.date()):
+                    continue
+                yield (parsed_date, row_number, number_column), user_name, number, date_str
+
+def iter_export_rows(spreadsheet: gspread.Spreadsheet, sheet_name: str, date_from: datetime, date_to: datetime, selected_users: List[str]):
+    # Повторы определяются по времени скана, а не по порядку строк: строки разных
+    # сотрудников между собой по времени не упорядочены. Лист читается один раз,
+    # сканы складываются во временный файл, а в памяти остаётся только первый скан
+    # каждого номера у каждого сотрудника. Второй проход идёт по временному файлу.
+    sheet = spreadsheet.worksheet(sheet_name)
+    first_scans: dict[str, dict[str, tuple]] = {}
+    with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as spool:
+        spool_writer = csv.writer(spool)
+        for key, user_name, number, date_str in iter_export_scans(sheet, date_from, date_to, selected_users):
+            owners = first_scans.setdefault(number, {})
+            if user_name not in owners or key < owners[user_name]:
+                owners[user_name] = key
+            parsed_date, row_number, number_column = key
+            spool_writer.writerow([user_name, number, date_str, parsed_date.isoformat(), row_number, number_column])
+        spool.seek(0)
+        for user_name, number, date_str, parsed_iso, row_number, number_column in csv.reader(spool):
+            parsed_date = datetime.fromisoformat(parsed_iso)
+            key = (parsed_date, int(row_number), int(number_column))
+            owners = first_scans[number]
+            repeated_by_user = owners[user_name] < key
+            repeated_by_others = any(first < key for name, first in owners.items() if name != user_name)
+            yield [
+                user_name, number, date_str,
+                parsed_date.strftime("%d.%m.%Y"), parsed_date.strftime("%H:%M"),
+                "да" if repeated_by_user else "", "да" if repeated_by_others else ""
+            ]
+
+def write_export_file(spreadsheet: gspread.Spreadsheet, sheet_name: str, date_from: datetime, date_to: datetime, export_format: str, selected_users: List[str]) -> Tuple[Path, int]:
+    TEMP_DIR.mkdir(parents=True, exist_ok=True)
+    file_path = TEMP_DIR / f"export_{date_from.strftime('%d.%m')}-{date_to.strftime('%d.%m')}_{os.getpid()}.{export_format}"
+    rows = iter_export_rows(spreadsheet, sheet_name, date_from, date_to, selected_users)
+    count = 0
+    if export_format == "csv":
+        with file_path.open("w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(EXPORT_HEADER)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    else:
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append(EXPORT_HEADER)
+        for row in rows:
+            worksheet.append(row)
+            count += 1
+        workbook.save(file_path)
+    return file_path, count
+
+async def export_sheet_async(spreadsheet: gspread.Spreadsheet, sheet_name: str, date_from: datetime, date_to: datetime, export_format: str, selected_users: List[str]) -> Tuple[Path, int]:
+    return await SHEETS_READ_EXECUTOR.run(write_export_file, spreadsheet, sheet_name, date_from, date_to, export_format, selected_users)
+
+BACKGROUND_RETRY_MIN_DELAY: int = 10
+BACKGROUND_RETRY_MAX_DELAY: int = 600
 
 async def background_refresh() -> None:
+    # При ошибке (сеть, переполненный пул) повторяем с нарастающей паузой,
+    # чтобы индекс самокатов не оставался пустым до следующего планового обновления
+    retry_delay = BACKGROUND_RETRY_MIN_DELAY
     while True:
         try:
-            await get_spreadsheet_async()
+            spreadsheet = await get_spreadsheet_async()
+            await rebuild_scooter_index_async(spreadsheet, "QR Codes")
+            retry_delay = BACKGROUND_RETRY_MIN_DELAY
             await asyncio.sleep(43200)
         except Exception as e:
-            logging.error(f"Error during background refresh: {e}")
-            await asyncio.sleep(43200)
+            logging.error(f"Error during background refresh, retrying in {retry_delay}s: {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, BACKGROUND_RETRY_MAX_DELAY)
 
 def rotate_image(image: np.ndarray, angle: float) -> np.ndarray:
     (h, w) = image.shape[:2]
@@ -474,38 +974,136 @@ def rotate_image(image: np.ndarray, angle: float) -> np.ndarray:
     rotated = cv2.warpAffine(image, M, (w, h))
     return rotated
 
-def extract_number_from_yellow(image_path: str) -> Optional[str]:
-    import cv2
-    import numpy as np
-    import pytesseract
-    import re
-
-    image = cv2.imread(image_path)
-    if image is None:
-        return None
+# ------------- PLATE LOCALIZATION -------------
+# Жёлтые номерные таблички ищем по контурам маски, отбрасываем кандидатов по площади
+# и пропорциям, выравниваем каждый и отдаём в tesseract только плотные ROI.
+# Если кандидатов нет, остаётся старый способ — OCR нижней части маски.
+# Каждый вызов tesseract — отдельный процесс, поэтому на одно изображение
+# их не больше PLATE_OCR_BUDGET.
+PLATE_LOWER_YELLOW = np.array([15, 80, 120])
+PLATE_UPPER_YELLOW = np.array([40, 255, 255])
+PLATE_MIN_AREA_PX: int = 1500
+PLATE_MAX_AREA_RATIO: float = 0.9
+PLATE_MAX_ASPECT: float = 4.5
+PLATE_MIN_FILL: float = 0.6
+PLATE_SQUARE_ASPECT: float = 1.15
+PLATE_CLOSE_KERNEL_RATIO: float = 0.015
+PLATE_MAX_CANDIDATES: int = 3
+PLATE_OCR_BUDGET: int = 4
+PLATE_OCR_HEIGHT: int = 160
+PLATE_OCR_CONFIGS: Tuple[str, str] = (
+    '--psm 6 -c tessedit_char_whitelist=0123456789',
+    '--psm 7 -c tessedit_char_whitelist=0123456789',
+)
 
+def yellow_mask(image: np.ndarray) -> np.ndarray:
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    lower_yellow = np.array([15, 80, 120])
-    upper_yellow = np.array([40, 255, 255])
-    mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
+    return cv2.inRange(hsv, PLATE_LOWER_YELLOW, PLATE_UPPER_YELLOW)
+
+def order_box_points(rect) -> Tuple[np.ndarray, bool]:
+    # Углы считаются в системе координат самого прямоугольника: ось u идёт вдоль длинной
+    # стороны слева направо, v — поперёк, вниз. Порядок: левый верх, правый верх,
+    # правый низ, левый низ. Второе значение — табличка наклонена больше чем на 45°
+    # и может оказаться вверх ногами.
+    box = cv2.boxPoints(rect)
+    center = box.mean(axis=0)
+    edge_a, edge_b = box[1] - box[0], box[2] - box[1]
+    u = edge_a if np.linalg.norm(edge_a) >= np.linalg.norm(edge_b) else edge_b
+    u = u / np.linalg.norm(u)
+    if u[0] < 0 or (u[0] == 0 and u[1] < 0):
+        u = -u
+    v = np.array([-u[1], u[0]])
+    ordered = [None] * 4
+    for point in box:
+        du, dv = np.dot(point - center, u), np.dot(point - center, v)
+        ordered[(0 if du < 0 else 1) if dv < 0 else (3 if du < 0 else 2)] = point
+    return np.array(ordered, dtype=np.float32), abs(u[1]) > abs(u[0])
+
+def find_plate_candidates(image: np.ndarray, mask: np.ndarray) -> List[Tuple[np.ndarray, bool]]:
+    # Ядро закрытия растёт вместе с разрешением, чтобы цифры не рвали табличку на куски
+    kernel_size = max(3, int(max(image.shape[:2]) * PLATE_CLOSE_KERNEL_RATIO)) | 1
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    image_area = image.shape[0] * image.shape[1]
+    scored = []
+    for contour in contours:
+        contour_area = cv2.contourArea(contour)
+        if contour_area < PLATE_MIN_AREA_PX:
+            continue
+        rect = cv2.minAreaRect(contour)
+        rect_w, rect_h = rect[1]
+        rect_area = rect_w * rect_h
+        if not rect_area or rect_area > image_area * PLATE_MAX_AREA_RATIO:
+            continue
+        aspect = max(rect_w, rect_h) / min(rect_w, rect_h)
+        fill = contour_area / rect_area
+        if aspect > PLATE_MAX_ASPECT or fill < PLATE_MIN_FILL:
+            continue
+        scored.append((fill * contour_area, rect, contour, aspect))
+
+    scored.sort(key=lambda x: -x[0])
+    return [deskew_plate(image, rect, contour, aspect) for _, rect, contour, aspect in scored[:PLATE_MAX_CANDIDATES]]
+
+def deskew_plate(image: np.ndarray, rect, contour: np.ndarray, aspect: float) -> Tuple[np.ndarray, bool]:
+    # У почти квадратных и круглых наклеек угол minAreaRect случайный, их не поворачиваем
+    if aspect < PLATE_SQUARE_ASPECT:
+        x, y, w, h = cv2.boundingRect(contour)
+        return image[y:y + h, x:x + w], False
+    src, steep = order_box_points(rect)
+    width = int(round(np.linalg.norm(src[1] - src[0])))
+    height = int(round(np.linalg.norm(src[3] - src[0])))
+    dst = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(image, M, (width, height)), steep
+
+def binarize_plate(plate: np.ndarray) -> np.ndarray:
+    h, w = plate.shape[:2]
+    scale = PLATE_OCR_HEIGHT / h
+    plate = cv2.resize(plate, (max(int(w * scale), 1), PLATE_OCR_HEIGHT), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    gray = cv2.cvtColor(plate, cv2.COLOR_BGR2GRAY)
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # tesseract ждёт тёмные цифры на светлом фоне
+    if cv2.countNonZero(thresh) < thresh.size / 2:
+        thresh = 255 - thresh
+    return thresh
+
+def iter_plate_ocr_jobs(plates: List[Tuple[np.ndarray, bool]]):
+    # Сначала вся табличка (номер в две строки), затем нижняя полоса, где номер стоит под QR-кодом.
+    # Переворот на 180° пробуем только для лучшего кандидата с крутым наклоном.
+    for index, (plate, steep) in enumerate(plates):
+        thresh = binarize_plate(plate)
+        variants = [thresh, cv2.rotate(thresh, cv2.ROTATE_180)] if index == 0 and steep else [thresh]
+        for variant in variants:
+            yield variant, PLATE_OCR_CONFIGS[0]
+            yield variant[int(PLATE_OCR_HEIGHT * 0.6):, :], PLATE_OCR_CONFIGS[1]
+
+def run_plate_ocr(region: np.ndarray, config: str) -> Optional[str]:
+    ocr_result = pytesseract.image_to_string(region, config=config)
+    match = re.search(r'\d{8}', re.sub(r'\s', '', ocr_result))
+    return match.group(0) if match else None
 
+def ocr_yellow_bottom_crop(image: np.ndarray, mask: np.ndarray) -> Optional[str]:
     yellow = cv2.bitwise_and(image, image, mask=mask)
     gray = cv2.cvtColor(yellow, cv2.COLOR_BGR2GRAY)
     _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    count_black = np.sum(thresh == 0)
-    count_white = np.sum(thresh == 255)
-    if count_black < count_white:
+    if cv2.countNonZero(thresh) > thresh.size / 2:
         thresh = 255 - thresh
 
     h = thresh.shape[0]
-    crop = thresh[int(h*0.6):, :]
-
-    custom_config = '--psm 7 -c tessedit_char_whitelist=0123456789'
-    ocr_result = pytesseract.image_to_string(crop, config=custom_config)
-
-    match = re.search(r'\d{8}', ocr_result)
-    if match:
-        return match.group(0)
+    return run_plate_ocr(thresh[int(h*0.6):, :], PLATE_OCR_CONFIGS[1])
+
+def extract_number_from_yellow(image: np.ndarray) -> Optional[str]:
+    mask = yellow_mask(image)
+    plates = find_plate_candidates(image, mask)
+    if not plates:
+        return ocr_yellow_bottom_crop(image, mask)
+    for calls, (region, config) in enumerate(iter_plate_ocr_jobs(plates)):
+        if calls >= PLATE_OCR_BUDGET:
+            break
+        number = run_plate_ocr(region, config)
+        if number:
+            return number
     return None
 
 def decode_qr_code(image_path: str) -> Optional[str]:
@@ -527,13 +1125,127 @@ def decode_qr_code(image_path: str) -> Optional[str]:
                 logging.info(f"Extracted number: {number} at angle {angle}")
                 return number
 
-    number = extract_number_from_yellow(image_path)
+    number = extract_number_from_yellow(image)
     if number:
         logging.info(f"Extracted number via improved OCR: {number}")
         return number
 
     return None
 
+# ------------- PHOTO SIZE SELECTION -------------
+# Сначала пробуем средний размер фото от Telegram и только при неудаче качаем оригинал.
+# Успешность по каждому размеру копится в PHOTO_SIZE_STATS_PATH, чтобы подбирать PHOTO_START_SIDE.
+PHOTO_START_SIDE: int = int(os.environ.get("PHOTO_START_SIDE", "800"))
+
+async def download_photo_async(photo) -> Path:
+    file = await photo.get_file()
+    file_bytes = await file.download_as_bytearray()
+    TEMP_DIR.mkdir(parents=True, exist_ok=True)
+    file_path = TEMP_DIR / f"{file.file_id}.jpg"
+    with file_path.open('wb') as f:
+        f.write(file_bytes)
+    return file_path
+
+def remove_temp_file(file_path: Path) -> None:
+    try:
+        file_path.unlink()
+    except Exception as e:
+        logging.error(f"Ошибка удаления временного файла {file_path}: {e}")
+
+def photo_side(photo) -> int:
+    return max(photo.width, photo.height)
+
+def select_photo_sizes(photos) -> list:
+    sizes = sorted(photos, key=photo_side)
+    largest = sizes[-1]
+    start = next((p for p in sizes if photo_side(p) >= PHOTO_START_SIDE), largest)
+    return [start] if start is largest else [start, largest]
+
+# Счётчики живут в памяти и сбрасываются на диск не чаще раза в PHOTO_SIZE_STATS_FLUSH_INTERVAL секунд.
+# Это только телеметрия: любая ошибка чтения или записи логируется и не мешает скану.
+PHOTO_SIZE_STATS_FLUSH_INTERVAL: float = 60.0
+photo_size_stats: Optional[dict] = None
+photo_size_stats_flushed_at: float = 0.0
+
+def load_photo_size_stats() -> dict:
+    global photo_size_stats
+    if photo_size_stats is None:
+        photo_size_stats = {}
+        try:
+            if PHOTO_SIZE_STATS_PATH.exists():
+                with open(PHOTO_SIZE_STATS_PATH, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    photo_size_stats = data
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to load photo size stats, starting from scratch: {e}")
+    return photo_size_stats
+
+def flush_photo_size_stats() -> None:
+    global photo_size_stats_flushed_at
+    photo_size_stats_flushed_at = time.monotonic()
+    tmp_path = PHOTO_SIZE_STATS_PATH.with_suffix(".json.tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(load_photo_size_stats(), f)
+        os.replace(tmp_path, PHOTO_SIZE_STATS_PATH)
+    except OSError as e:
+        logging.error(f"Failed to save photo size stats: {e}")
+
+def record_photo_size_result(side: int, success: bool, rescued_by_full: bool = False) -> None:
+    try:
+        entry = load_photo_size_stats().setdefault(str(side), {"attempts": 0, "successes": 0})
+        entry["attempts"] = entry.get("attempts", 0) + 1
+        if success:
+            entry["successes"] = entry.get("successes", 0) + 1
+        if rescued_by_full:
+            entry["rescued_by_full"] = entry.get("rescued_by_full", 0) + 1
+    except Exception as e:
+        logging.error(f"Failed to record photo size stats: {e}")
+        return
+    if time.monotonic() - photo_size_stats_flushed_at >= PHOTO_SIZE_STATS_FLUSH_INTERVAL:
+        flush_photo_size_stats()
+
+def get_photo_size_stats_message() -> str:
+    data = load_photo_size_stats()
+    if not data:
+        return "Статистика по размерам фото пока не собрана."
+    lines = [f"Стартовый размер фото: {PHOTO_START_SIDE}px"]
+    try:
+        for side, entry in sorted(data.items(), key=lambda x: int(x[0])):
+            attempts, successes = entry.get("attempts", 0), entry.get("successes", 0)
+            rate = round(100 * successes / attempts) if attempts else 0
+            line = f"{side}px: {successes}/{attempts} ({rate}%)"
+            if entry.get("rescued_by_full"):
+                line += f", распознано только в оригинале: {entry['rescued_by_full']}"
+            lines.append(line)
+    except Exception as e:
+        logging.error(f"Malformed photo size stats: {e}")
+        lines.append("Статистика повреждена.")
+    return "\n".join(lines)
+
+async def recognize_photo_async(photos) -> Optional[str]:
+    # Неудача на среднем размере учитывается только если оригинал распознался:
+    # фото, которые не читаются вовсе, не должны занижать статистику стартового размера
+    failed_side: Optional[int] = None
+    for photo in select_photo_sizes(photos):
+        file_path = await download_photo_async(photo)
+        try:
+            number = await IMAGE_EXECUTOR.run(decode_qr_code, str(file_path))
+        finally:
+            remove_temp_file(file_path)
+        side = photo_side(photo)
+        if number:
+            if failed_side is not None:
+                record_photo_size_result(failed_side, False, rescued_by_full=True)
+            record_photo_size_result(side, True)
+            logging.info(f"Recognized {number} at photo size {side}px")
+            return number
+        logging.info(f"Nothing recognized at photo size {side}px")
+        failed_side = side
+    record_photo_size_result(failed_side, False)
+    return None
+
 # ------------- HANDLERS -------------
 
 async def save_notes_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -541,15 +1253,27 @@ async def save_notes_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         log_unauthorized_access(update.message.from_user.id, "save_notes_handler")
         await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа.")
         return
-    note = update.message.text
-    NOTES_DIR.mkdir(parents=True, exist_ok=True)
-    filename = NOTES_DIR / f"notes_{os.getpid()}.json"
-    if is_duplicate(filename, note):
+    note = " ".join(context.args).strip() if context.args else ""
+    if not note:
+        # Кнопка или команда без текста: следующее текстовое сообщение станет заметкой.
+        # Любой другой ввод (кнопка, фото, команда, номер самоката) ожидание сбрасывает.
+        context.user_data["awaiting_note"] = True
+        await context.bot.send_message(
+            chat_id=update.message.chat_id,
+            text="Отправьте текст заметки. Любая кнопка, команда или номер самоката отменяют ввод."
+        )
+        return
+    await save_note_text(update, context, note)
+
+async def clear_awaiting_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.pop("awaiting_note", None)
+
+async def save_note_text(update: Update, context: ContextTypes.DEFAULT_TYPE, note: str) -> None:
+    record = add_note(update.message.from_user.id, note)
+    if record is None:
         await context.bot.send_message(chat_id=update.message.chat_id, text="Такая заметка уже есть.")
         return
-    with filename.open("w", encoding="utf-8") as file:
-        json.dump(note, file)
-    await context.bot.send_message(chat_id=update.message.chat_id, text=f"Заметка сохранена в файл: {filename}")
+    await context.bot.send_message(chat_id=update.message.chat_id, text=f"Заметка №{record['id']} сохранена.")
 
 async def delete_last_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_user_allowed(update.message.from_user.id):
@@ -557,10 +1281,28 @@ async def delete_last_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа.")
         return
 
-    qr_code_file = NOTES_DIR / "qr_code_data.json"
-    if qr_code_file.exists():
-        qr_code_file.unlink()
-    await context.bot.send_message(chat_id=update.message.chat_id, text="Последняя заметка удалена.")
+    record = delete_last_user_note(update.message.from_user.id)
+    if record is None:
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Заметок нет.")
+        return
+    await context.bot.send_message(chat_id=update.message.chat_id, text=f"Последняя заметка удалена: {record['text']}")
+
+async def list_notes_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_user_allowed(update.message.from_user.id):
+        log_unauthorized_access(update.message.from_user.id, "list_notes_handler")
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа.")
+        return
+    page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    notes, total_pages = list_user_notes(update.message.from_user.id, page)
+    if not notes:
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Заметок нет.")
+        return
+    page = min(max(page, 1), total_pages)
+    lines = [f"📝 Заметки (стр. {page}/{total_pages}):"]
+    lines.extend(f"{n['id']}. [{n['ts']}] {n['text']}" for n in notes)
+    if page < total_pages:
+        lines.append(f"\nСледующая страница: /notes {page + 1}")
+    await context.bot.send_message(chat_id=update.message.chat_id, text="\n".join(lines))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_user_allowed(update.message.from_user.id):
@@ -588,12 +1330,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/help — помощь\n"
         "/save_notes — сохранить заметку\n"
         "/delete_last_note — удалить последнюю заметку\n"
+        "/notes [страница] — список заметок\n"
 
         "Доступны кнопки: Моя статистика, Мой график, Написать админу.\n"
 
         "Доступны кнопки: Моя статистика, Написать админу.\n"
 
-        "Кнопки «Выгрузка» и «Таблица» доступны спецпользователям."
+        "Кнопки «Выгрузка» и «Таблица» доступны спецпользователям.\n"
+        "/export [дд.мм] [дд.мм] [csv|xlsx] [фамилии] — выгрузка истории файлом (спецпользователи)"
     )
     await context.bot.send_message(chat_id=update.message.chat_id, text=text, reply_markup=reply_markup)
 
@@ -602,7 +1346,11 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         log_unauthorized_access(update.message.from_user.id, "status")
         await context.bot.send_message(chat_id=update.message.chat_id, text="Бот работает.")
         return
-    await context.bot.send_message(chat_id=update.message.chat_id, text="Бот работает.")
+    text = "Бот работает."
+    if update.message.from_user.id == ADMIN_USER_ID:
+        text += "\n\n" + get_photo_size_stats_message()
+        text += "\n\n" + get_executor_stats_message()
+    await context.bot.send_message(chat_id=update.message.chat_id, text=text)
 
 async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_user_allowed(update.message.from_user.id):
@@ -610,40 +1358,120 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
         await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа.")
         return
     user_id = update.message.from_user.id
-    photo = update.message.photo[-1]
-    file = await photo.get_file()
-    file_bytes = await file.download_as_bytearray()
-    TEMP_DIR.mkdir(parents=True, exist_ok=True)
-    file_path = TEMP_DIR / f"{file.file_id}.jpg"
-    with file_path.open('wb') as f:
-        f.write(file_bytes)
-    await process_qr_photo(update, context, str(file_path), user_id)
+    if update.message.media_group_id:
+        collect_media_group_photo(update, context)
+        return
+    await process_qr_photo(update, context, update.message.photo, user_id)
+
+SCAN_NOT_SAVED_TEXT: str = "Самокат {} НЕ сохранён: таблица недоступна или сервер перегружен. Отправьте его ещё раз чуть позже."
+
+async def save_scan_async(user_id: int, number: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     try:
-        file_path.unlink()
-    except Exception as e:
-        logging.error(f"Ошибка удаления временного файла {file_path}: {e}")
+        spreadsheet = await get_spreadsheet_async()
+    except ExecutorOverloadedError as e:
+        logging.error(f"Scan {number} of user {user_id} not saved: {e}")
+        return False
+    return await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [number], context)
 
-async def process_qr_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str, user_id: int) -> None:
+async def process_qr_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, photos, user_id: int) -> None:
     await context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
-    qr_text = decode_qr_code(file_path)
+    try:
+        qr_text = await recognize_photo_async(photos)
+    except ExecutorOverloadedError as e:
+        await context.bot.send_message(chat_id=update.message.chat_id, text=str(e))
+        return
     if not qr_text:
         await context.bot.send_message(chat_id=update.message.chat_id, text="QR-код и номер под ним не распознаны.")
         return
-    spreadsheet = await get_spreadsheet_async()
-    await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [qr_text], context)
+    if not await save_scan_async(user_id, qr_text, context):
+        await context.bot.send_message(chat_id=update.message.chat_id, text=SCAN_NOT_SAVED_TEXT.format(qr_text))
+        return
 
     await context.bot.send_message(chat_id=update.message.chat_id, text=f"QR-код или номер {qr_text} сохранён.")
 
+# ------------- АЛЬБОМЫ (MEDIA GROUPS) -------------
+# Telegram присылает каждое фото альбома отдельным апдейтом с общим media_group_id,
+# поэтому фото копятся в буфере и обрабатываются одной пачкой после короткой паузы.
+MEDIA_GROUP_COLLECT_DELAY: float = 1.5
+media_group_buffers: dict[str, list] = {}
+# Цикл событий держит задачи по слабой ссылке, поэтому храним их до завершения
+media_group_tasks: set = set()
+
+def collect_media_group_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    group_id = update.message.media_group_id
+    buffer = media_group_buffers.get(group_id)
+    if buffer is None:
+        buffer = media_group_buffers[group_id] = []
+        task = asyncio.create_task(process_media_group(group_id, update.message.chat_id, update.message.from_user.id, context))
+        media_group_tasks.add(task)
+        task.add_done_callback(media_group_tasks.discard)
+    buffer.append(update.message.photo)
+
+async def process_media_group(group_id: str, chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.sleep(MEDIA_GROUP_COLLECT_DELAY)
+    photos = media_group_buffers.pop(group_id, [])
+    if not photos:
+        return
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        results = await asyncio.gather(*(recognize_photo_async(album_photo) for album_photo in photos), return_exceptions=True)
+
+        unrecognized = 0
+        overloaded = 0
+        numbers: List[str] = []
+        album_duplicates: List[str] = []
+        for result in results:
+            if isinstance(result, ExecutorOverloadedError):
+                overloaded += 1
+            elif isinstance(result, Exception):
+                logging.error(f"Album photo processing error: {result}")
+                unrecognized += 1
+            elif not result:
+                unrecognized += 1
+            elif result in numbers:
+                album_duplicates.append(result)
+            else:
+                numbers.append(result)
+
+        saved = True
+        sheet_duplicates: List[str] = []
+        if numbers:
+            spreadsheet = await get_spreadsheet_async()
+            saved, sheet_duplicates = await append_batch_to_google_sheets_async(spreadsheet, "QR Codes", user_id, numbers, context)
+    except Exception as e:
+        logging.error(f"Media group {group_id} processing error: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Ошибка обработки альбома. Попробуйте отправить фото ещё раз.")
+        return
+
+    lines = [f"Альбом обработан: {len(photos)} фото."]
+    if not saved:
+        lines.append("Не удалось записать в таблицу: " + ", ".join(numbers) + ". Попробуйте отправить фото ещё раз.")
+        album_duplicates = []
+    new_numbers = [n for n in numbers if n not in sheet_duplicates]
+    if saved and new_numbers:
+        lines.append("Сохранено: " + ", ".join(new_numbers))
+    if sheet_duplicates or album_duplicates:
+        lines.append("Дубликаты: " + ", ".join(sheet_duplicates + album_duplicates))
+    if unrecognized:
+        lines.append(f"Не распознано: {unrecognized} фото")
+    if overloaded:
+        lines.append(f"Не обработано из-за нагрузки: {overloaded} фото. Отправьте их ещё раз чуть позже.")
+    await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
+
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_user_allowed(update.message.from_user.id):
         log_unauthorized_access(update.message.from_user.id, "handle_text_message")
         await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа.")
         return
     text = update.message.text
+    if context.user_data.pop("awaiting_note", False):
+        await save_note_text(update, context, text)
+        return
     number = is_valid_number(text)
     if number:
-        spreadsheet = await get_spreadsheet_async()
-        await append_to_google_sheets_async(spreadsheet, "QR Codes", update.message.from_user.id, [number], context)
+        if not await save_scan_async(update.message.from_user.id, number, context):
+            await context.bot.send_message(chat_id=update.message.chat_id, text=SCAN_NOT_SAVED_TEXT.format(number))
+            return
         update_last_activity(update.message.from_user.id)
         await context.bot.send_message(chat_id=update.message.chat_id, text=f"Самокат {number} сохранён.")
     else:
@@ -665,6 +1493,39 @@ async def handle_vygruzka(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = ReplyKeyboardMarkup([[BUTTON_RETURN]], resize_keyboard=True)
     await context.bot.send_message(chat_id=update.message.chat_id, text=summary, reply_markup=reply_markup)
 
+async def handle_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    if user_id not in SPECIAL_USER_IDS:
+        log_unauthorized_access(user_id, "handle_export")
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа к этой функции.")
+        return
+    try:
+        date_from, date_to, export_format, selected_users = parse_export_args(context.args or [])
+    except ValueError:
+        await context.bot.send_message(chat_id=update.message.chat_id, text=f"Неверная дата.\n{EXPORT_USAGE}")
+        return
+    if not selected_users:
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Сотрудники не найдены.")
+        return
+    file_path = None
+    try:
+        await context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+        spreadsheet = await get_spreadsheet_async()
+        file_path, count = await export_sheet_async(spreadsheet, "QR Codes", date_from, date_to, export_format, selected_users)
+        with file_path.open("rb") as f:
+            await context.bot.send_document(
+                chat_id=update.message.chat_id,
+                document=f,
+                filename=file_path.name,
+                caption=f"Выгрузка {date_from.strftime('%d.%m')}–{date_to.strftime('%d.%m')}: {count} записей"
+            )
+    except Exception as e:
+        logging.error(f"Export error: {e}")
+        await context.bot.send_message(chat_id=update.message.chat_id, text=f"Ошибка выгрузки: {e}")
+    finally:
+        if file_path is not None:
+            remove_temp_file(file_path)
+
 async def handle_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
     if user_id not in SPECIAL_USER_IDS:
@@ -698,8 +1559,12 @@ async def handle_my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await context.bot.send_message(chat_id=update.message.chat_id, text="Нет доступа к этой функции.")
         return
     await context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
-    spreadsheet = await get_spreadsheet_async()
-    stats = await get_personal_stats(spreadsheet, user_id)
+    try:
+        spreadsheet = await get_spreadsheet_async()
+        stats = await get_personal_stats(spreadsheet, user_id)
+    except ExecutorOverloadedError as e:
+        await context.bot.send_message(chat_id=update.message.chat_id, text=str(e))
+        return
     reply_markup = ReplyKeyboardMarkup([[BUTTON_RETURN]], resize_keyboard=True)
     await context.bot.send_message(
         chat_id=update.message.chat_id,
@@ -737,8 +1602,11 @@ async def test_append_and_duplicate(update: Update, context: ContextTypes.DEFAUL
     await context.bot.send_message(chat_id=update.message.chat_id, text="Тест: запись и проверка дубликатов (A/B)...")
     spreadsheet = await get_spreadsheet_async()
     test_number = "00123456"
-    await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [test_number], context)
-    await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [test_number], context)
+    first = await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [test_number], context)
+    second = await append_to_google_sheets_async(spreadsheet, "QR Codes", user_id, [test_number], context)
+    if not (first and second):
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Тест: запись в таблицу не удалась.")
+        return
     await context.bot.send_message(chat_id=update.message.chat_id, text="Тест завершён. Проверьте дублирование (см. A/B).")
 
 async def test_qr_decode(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -753,11 +1621,19 @@ async def main() -> None:
     logging.info("Called main function")
     application = Application.builder().token(BOT_TOKEN).build()
 
+    # Группа -1 срабатывает раньше остальных: сбрасывает ожидание заметки при любом вводе, кроме свободного текста
+    menu_buttons = "|".join((BUTTON_VYGRUZKA, BUTTON_RETURN, BUTTON_SAVE_NOTES, BUTTON_DELETE_NOTE, BUTTON_TABLE, BUTTON_MY_STATS, BUTTON_CONTACT_ADMIN, BUTTON_MY_SHIFTS))
+    not_a_note = filters.COMMAND | filters.PHOTO | filters.Regex(NUMBER_PATTERN) | filters.Regex(f"^({menu_buttons})$")
+    application.add_handler(MessageHandler(not_a_note, clear_awaiting_note), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status))
     application.add_handler(CommandHandler("test_append", test_append_and_duplicate))
     application.add_handler(CommandHandler("test_qr", test_qr_decode))
+    application.add_handler(CommandHandler("save_notes", save_notes_handler))
+    application.add_handler(CommandHandler("delete_last_note", delete_last_note))
+    application.add_handler(CommandHandler("notes", list_notes_handler))
+    application.add_handler(CommandHandler("export", handle_export))
     application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_SAVE_NOTES}$"), save_notes_handler))
     application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_DELETE_NOTE}$"), delete_last_note))
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_photo_with_text))
@@ -772,6 +1648,7 @@ async def main() -> None:
     refresh_task = asyncio.create_task(background_refresh())
     await application.run_polling()
     refresh_task.cancel()
+    flush_photo_size_stats()
     logging.info("Bot is running and polling for updates")
 
 if __name__ == '__main__':